@@ -1,13 +1,22 @@
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from glob import glob
+import hashlib
+import logging
 import os
-from typing import List
+from typing import List, Optional, Tuple
 from decouple import config
 from gtts import gTTS
-import pygame
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import sys
-from time import sleep
+import tempfile
+import time
+from urllib3.util.retry import Retry
 
 
 SECRET_API_KEY = config("SECRET_API_KEY")
@@ -24,11 +33,61 @@ ROUNDED_DIFFERENCE_OPEN_INTEREST = config(
     "ROUNDED_DIFFERENCE_OPEN_INTEREST", default=-6, cast=int
 )
 SLEEP_INTERVAL = config("SLEEP_INTERVAL", default=2, cast=int)
+REQUEST_TIMEOUT = config("REQUEST_TIMEOUT", default=10, cast=int)
 INTERVAL = config("INTERVAL", default="5min")
 TMP_MP3_DIR = config("SPEECH_MP3_DIR", default="/tmp")
-
-
-pygame.mixer.init()
+MAX_CACHED_MP3 = config("MAX_CACHED_MP3", default=64, cast=int)
+MAX_SCANNED_DATA = 2**14
+SCANNED_KINDS = {"open interest": 0, "long": 1, "short": 2}
+INTERVAL_SECONDS = {
+    "1min": 60,
+    "5min": 5 * 60,
+    "15min": 15 * 60,
+    "30min": 30 * 60,
+    "1hour": 60 * 60,
+    "2hour": 2 * 60 * 60,
+    "4hour": 4 * 60 * 60,
+    "6hour": 6 * 60 * 60,
+    "12hour": 12 * 60 * 60,
+    "daily": 24 * 60 * 60,
+}
+
+
+# only the scanner logs to stdout, third party loggers keep their defaults
+LOGGER = logging.getLogger("coinalyze")
+LOGGER.setLevel(logging.INFO)
+LOGGER.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter("%(message)s"))
+LOGGER.addHandler(_log_handler)
+
+# cached mp3 files and loaded sounds from least to most recently used, mp3 files
+# from earlier runs are picked up by their modification time
+MP3_CACHE_DIR = f"{TMP_MP3_DIR}/coinalyze-speech"
+os.makedirs(MP3_CACHE_DIR, exist_ok=True)
+MP3_CACHE: OrderedDict = OrderedDict(
+    (path, None)
+    for path in sorted(glob(f"{MP3_CACHE_DIR}/*.mp3"), key=os.path.getmtime)
+)
+SOUND_CACHE: OrderedDict = OrderedDict()
+
+# reuse one session so successive polls keep the TLS connection alive, transient
+# server errors are retried on the same connection pool
+SESSION = requests.Session()
+SESSION.headers.update({"api_key": SECRET_API_KEY})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods={"GET"},
+        ),
+    ),
+)
 
 
 def print_there(x: int, y: int, text: str) -> None:
@@ -37,31 +96,161 @@ def print_there(x: int, y: int, text: str) -> None:
     sys.stdout.flush()
 
 
-def convert_speech_to_text(title: str, text: str) -> None:
-    """Convert text to speech and play the speech
+def scanned_key(candle_time: int, kind: str, value: float) -> int:
+    """Returns a packed key for the scanned data, the candle time takes the lowest 32
+    bits, the kind the next 2 bits and the value in cents all bits above those
+
+    Args:
+        candle_time (int): unix timestamp of the candle
+        kind (str): kind of the detection, one of SCANNED_KINDS
+        value (float): amount of the detection
+    """
+    return (
+        round(value * 100) << 34 | SCANNED_KINDS[kind] << 32 | candle_time & 0xFFFFFFFF
+    )
+
+
+@lru_cache(maxsize=512)
+def format_timestamp(timestamp: int) -> str:
+    """Returns the timestamp as a readable datetime string, candles share timestamps
+    so the result is cached
+
+    Args:
+        timestamp (int): unix timestamp of the candle
+    """
+    return str(datetime.fromtimestamp(timestamp))
+
+
+@lru_cache(maxsize=None)
+def get_mixer():
+    """Returns the pygame mixer, pygame is only imported and initialised once the
+    first alert is spoken. Returns None when there is no usable audio device, the
+    error is only logged once"""
+    import pygame
+
+    if not pygame.mixer.get_init():
+        try:
+            pygame.mixer.init()
+        except pygame.error as e:
+            LOGGER.error(
+                "Could not initialise the audio mixer, speech is disabled: %s", e
+            )
+            return None
+    return pygame.mixer
+
+
+def speech_key(text: str) -> str:
+    """Returns the cache key for the speech of the text
 
     Args:
-        title (str): title of the speech for the temporary mp3 file
         text (str): text to convert to speech
     """
-    # save speech to an mp3 file
-    tts = gTTS(text=text, lang="en", slow=False)
-    tts.save(f"{TMP_MP3_DIR}/{title}.mp3")
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+
+def speech_mp3_path(text: str) -> str:
+    """Returns the path of the cached mp3 file for the text
+
+    Args:
+        text (str): text to convert to speech
+    """
+    return f"{MP3_CACHE_DIR}/{speech_key(text)}.mp3"
+
+
+def touch_mp3_cache(path: str) -> None:
+    """Mark the mp3 file as most recently used, the least recently used mp3 files
+    are removed when the cache grows too big
+
+    Args:
+        path (str): path to the cached mp3 file
+    """
+    if not os.path.exists(path):
+        MP3_CACHE.pop(path, None)
+        return
 
-    # play the mp3 file
-    pygame.mixer.music.load(f"/tmp/{title}.mp3")
-    pygame.mixer.music.set_volume(0.5)
-    pygame.mixer.music.play()
+    MP3_CACHE[path] = None
+    MP3_CACHE.move_to_end(path)
+    os.utime(path)
+    while len(MP3_CACHE) > MAX_CACHED_MP3:
+        old_path, _ = MP3_CACHE.popitem(last=False)
+        if os.path.exists(old_path):
+            os.remove(old_path)
 
-    # wait for the mp3 to finish
-    while pygame.mixer.music.get_busy():
-        sleep(1)
 
-    # unload the mp3 file
-    pygame.mixer.music.unload()
+def get_speech_mp3(text: str) -> str:
+    """Returns the path of the mp3 file for the text, the speech is only generated
+    when it is not cached yet
+
+    Args:
+        text (str): text to convert to speech
+
+    Returns:
+        str: path to the mp3 file
+    """
+    path = speech_mp3_path(text)
+    if not os.path.exists(path):
+        # save to a temporary file first, so a failed request leaves no broken mp3
+        fd, tmp_path = tempfile.mkstemp(dir=MP3_CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            gTTS(text=text, lang="en", slow=False).save(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    # remove the mp3 file
-    os.remove(f"{TMP_MP3_DIR}/{title}.mp3")
+    touch_mp3_cache(path)
+    return path
+
+
+async def convert_speech_to_text(text: str) -> None:
+    """Convert text to speech and play the speech
+
+    Args:
+        text (str): text to convert to speech
+    """
+    # load the sound once, gTTS does a blocking request so run it in a thread
+    mixer = get_mixer()
+    if mixer is None:
+        return
+
+    key = speech_key(text)
+    sound = SOUND_CACHE.get(key)
+    if sound is None:
+        path = await asyncio.to_thread(get_speech_mp3, text)
+        sound = mixer.Sound(file=path)
+        sound.set_volume(0.5)
+        SOUND_CACHE[key] = sound
+    else:
+        # keep the mp3 file of a frequently played sound on disk as well
+        touch_mp3_cache(speech_mp3_path(text))
+
+    # drop the least recently used sounds when the cache grows too big
+    SOUND_CACHE.move_to_end(key)
+    while len(SOUND_CACHE) > MAX_CACHED_MP3:
+        SOUND_CACHE.popitem(last=False)
+
+    # play the sound and wait for it to finish
+    sound.play()
+    while mixer.get_busy():
+        await asyncio.sleep(1)
+
+
+async def speech_worker(queue: asyncio.Queue) -> None:
+    """Play the queued speech texts one after another, so alerts never hold up
+    the scanning
+
+    Args:
+        queue (asyncio.Queue): queue with the texts to convert to speech
+    """
+    while True:
+        text = await queue.get()
+        try:
+            await convert_speech_to_text(text)
+        except Exception as e:
+            LOGGER.warning("%s", e)
+        finally:
+            queue.task_done()
 
 
 @dataclass
@@ -69,22 +258,48 @@ class CoinalyzeScanner:
     """Scans coinalyze to notify for changes in open interest and liquidations through
     text to speech"""
 
-    scanned_data: set
+    scanned_data: OrderedDict
+    speech_queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    last_liquidation_time: int = 0
+    last_open_interest_time: int = 0
 
     @property
     def params(self) -> dict:
         """Returns the parameters for the request to the API"""
+        now = int(time.time())
         return {
             "symbols": "BTCUSD.6",
-            "from": int(
-                datetime.timestamp(
-                    datetime.now() - timedelta(minutes=N_MINUTES_TIMEDELTA)
-                )
-            ),
-            "to": int(datetime.timestamp(datetime.now())),
+            "from": now - N_MINUTES_TIMEDELTA * 60,
+            "to": now,
             "interval": INTERVAL,
         }
 
+    def add_scanned_data(self, key: int) -> None:
+        """Add a scanned key, the oldest keys are dropped when the cache is full
+
+        Args:
+            key (int): scanned key from scanned_key
+        """
+        self.scanned_data[key] = key & 0xFFFFFFFF
+        self.scanned_data.move_to_end(key)
+        while len(self.scanned_data) > MAX_SCANNED_DATA:
+            self.scanned_data.popitem(last=False)
+
+    def remove_expired_scanned_data(self) -> None:
+        """Remove scanned keys of candles that ended before the requested time
+        window, the API will not return those candles again, keys are added in
+        candle time order so only the oldest keys need to be checked"""
+        expiry = (
+            time.time()
+            - N_MINUTES_TIMEDELTA * 60
+            - INTERVAL_SECONDS.get(INTERVAL, INTERVAL_SECONDS["daily"])
+        )
+        while self.scanned_data:
+            _, candle_time = next(iter(self.scanned_data.items()))
+            if candle_time >= expiry:
+                break
+            self.scanned_data.popitem(last=False)
+
     def handle_open_interest(self, history: dict) -> None:
         """Handle the open interest fluctuations
 
@@ -92,30 +307,29 @@ class CoinalyzeScanner:
             history (dict): history of the open interest
         """
 
-        candle_time, candle_open, candle_high, candle_low = (
+        candle_time, candle_high, candle_low = (
             history.get("t"),
-            history.get("o"),
             history.get("h"),
             history.get("l"),
         )
-        difference = abs(int(candle_high) - int(candle_low))
+        difference = int(abs(candle_high - candle_low))
+        if difference < MINIMAL_OPEN_INTEREST:
+            return
+
         rounded_difference = round(difference, ROUNDED_DIFFERENCE_OPEN_INTEREST)
-        open_interest_tuple = (candle_time, rounded_difference)
-        if (
-            difference >= MINIMAL_OPEN_INTEREST
-            and open_interest_tuple not in self.scanned_data
-        ):
-            print(
-                "Open interest changed:"
-                + "\t\t"
-                + f"${difference:>9}.-"
-                + f"\t at {datetime.fromtimestamp(candle_time)}"
+        open_interest_key = scanned_key(
+            candle_time, "open interest", rounded_difference
+        )
+        if open_interest_key not in self.scanned_data:
+            LOGGER.info(
+                "Open interest changed:\t\t$%9s.-\t at %s",
+                difference,
+                format_timestamp(candle_time),
             )
-            convert_speech_to_text(
-                title=f"{candle_time}-{candle_open}-{difference}",
-                text=f"Change in open interest with value {difference} detected",
+            self.speech_queue.put_nowait(
+                f"Change in open interest with value {difference} detected"
             )
-            self.scanned_data.add(open_interest_tuple)
+            self.add_scanned_data(open_interest_key)
 
     def handle_liquidation_set(self, history: dict) -> None:
         """Handle the liquidation set and check for liquidations
@@ -131,46 +345,55 @@ class CoinalyzeScanner:
                 liquidation_amount (int): amount of the liquidation
                 direction (str): direction of the liquidation
             """
-            liquidation_tuple = l_time, direction, liquidation_amount
-            if liquidation_tuple not in self.scanned_data:
-                print(
-                    "Liquidation detected:"
-                    + f"\t{direction}\t"
-                    + f"${liquidation_amount:>9}.-"
-                    + f"\t at {datetime.fromtimestamp(l_time)}"
+            liquidation_key = scanned_key(l_time, direction, liquidation_amount)
+            if liquidation_key not in self.scanned_data:
+                LOGGER.info(
+                    "Liquidation detected:\t%s\t$%9s.-\t at %s",
+                    direction,
+                    liquidation_amount,
+                    format_timestamp(l_time),
                 )
-                convert_speech_to_text(
-                    title=f"{l_time}-{direction}-{liquidation_amount}",
-                    text=f"{direction} liquidation with value {liquidation_amount} detected",
+                self.speech_queue.put_nowait(
+                    f"{direction} liquidation with value {liquidation_amount} detected"
                 )
-                self.scanned_data.add(liquidation_tuple)
+                self.add_scanned_data(liquidation_key)
 
-        l_time, l_long, l_short = (
-            history.get("t"),
-            history.get("l"),
-            history.get("s"),
-        )
+        # most candles have no liquidations above the minimum, skip those early
+        l_long, l_short = history.get("l", 0), history.get("s", 0)
+        if l_long <= MINIMAL_LIQUIDATION and l_short <= MINIMAL_LIQUIDATION:
+            return
+
+        l_time = history.get("t")
         if l_long > MINIMAL_LIQUIDATION:
             _handle_liquidation(l_long, "long")
         if l_short > MINIMAL_LIQUIDATION:
             _handle_liquidation(l_short, "short")
 
-    def handle_url(self, url: str, include_params: bool = True) -> List[dict]:
+    async def handle_url(
+        self, url: str, include_params: bool = True, params: Optional[dict] = None
+    ) -> List[dict]:
         """Handle the url and check for liquidations
 
         Args:
             url (str): url to check for liquidations
+            include_params (bool): whether to send the parameters with the request
+            params (Optional[dict]): parameters to use instead of self.params
         """
+        if include_params and params is None:
+            params = self.params
+
         try:
-            response = requests.get(
+            # requests is blocking, run it in a thread so other requests can overlap
+            response = await asyncio.to_thread(
+                SESSION.get,
                 url,
-                headers={"api_key": SECRET_API_KEY},
-                params=self.params if include_params else {},
+                params=params if include_params else {},
+                timeout=REQUEST_TIMEOUT,
             )
             response.raise_for_status()
-            response_json = response.json()
-        except Exception as e:
-            print(str(e))
+            response_json = orjson.loads(response.content)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            LOGGER.warning("%s", e)
             return []
 
         if not len(response_json):
@@ -178,30 +401,63 @@ class CoinalyzeScanner:
 
         return response_json[0].get("history", [])
 
+    async def fetch_histories(self) -> Tuple[List[dict], List[dict]]:
+        """Fetch the liquidation and open interest histories as one batch, both
+        requests share the same time window and run concurrently
 
-def main() -> None:
-    print("Starting the Coinalyze scanner")
+        Returns:
+            Tuple[List[dict], List[dict]]: liquidation and open interest histories
+        """
+        self.remove_expired_scanned_data()
 
-    scanner = CoinalyzeScanner(set())
+        params = self.params
+        return await asyncio.gather(
+            self.handle_url(LIQUIDATION_URL, params=params),
+            self.handle_url(OPEN_INTEREST_URL, params=params),
+        )
 
-    while True:
 
-        # print the current time at the bottom of the terminal
-        print_there(100, 0, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+async def main() -> None:
+    LOGGER.info("Starting the Coinalyze scanner")
+
+    scanner = CoinalyzeScanner(OrderedDict())
+
+    # play the alerts in the background while scanning continues, the task is
+    # cancelled when the scanner stops
+    speech_task = asyncio.create_task(speech_worker(scanner.speech_queue))
 
-        # check for liquidations
-        for history in scanner.handle_url(LIQUIDATION_URL):
-            scanner.handle_liquidation_set(history)
+    try:
+        while True:
 
-        # sleep for preferred interval
-        sleep(SLEEP_INTERVAL)
+            # print the current time at the bottom of the terminal
+            print_there(100, 0, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
-        for history in scanner.handle_url(OPEN_INTEREST_URL):
-            scanner.handle_open_interest(history)
+            # fetch liquidations and open interest in one batch
+            liquidations, open_interest = await scanner.fetch_histories()
+
+            # check for liquidations, older candles than the last one are handled
+            for history in liquidations:
+                if history.get("t", 0) >= scanner.last_liquidation_time:
+                    scanner.handle_liquidation_set(history)
+            scanner.last_liquidation_time = max(
+                (history.get("t", 0) for history in liquidations),
+                default=scanner.last_liquidation_time,
+            )
+
+            # check for open interest changes, same as for the liquidations
+            for history in open_interest:
+                if history.get("t", 0) >= scanner.last_open_interest_time:
+                    scanner.handle_open_interest(history)
+            scanner.last_open_interest_time = max(
+                (history.get("t", 0) for history in open_interest),
+                default=scanner.last_open_interest_time,
+            )
 
-        # sleep for preferred interval
-        sleep(SLEEP_INTERVAL)
+            # sleep for preferred interval, once per request to keep the request rate
+            await asyncio.sleep(2 * SLEEP_INTERVAL)
+    finally:
+        speech_task.cancel()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())